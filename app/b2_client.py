@@ -8,9 +8,10 @@ logger = structlog.get_logger(__name__)
 
 
 class B2Client:
-    def __init__(self):
+    def __init__(self, bucket_name: str = None):
         self.info = InMemoryAccountInfo()
         self.api = B2Api(self.info)
+        self.bucket_name = bucket_name or settings.b2_bucket_name
         self.bucket = None
         self._authenticate()
 
@@ -21,20 +22,30 @@ class B2Client:
                 settings.b2_application_key_id,
                 settings.b2_application_key,
             )
-            self.bucket = self.api.get_bucket_by_name(settings.b2_bucket_name)
+            self.bucket = self.api.get_bucket_by_name(self.bucket_name)
             logger.info("B2 authentication successful")
         except Exception as e:
             logger.error("B2 authentication failed", error=str(e))
             raise
 
     def upload_file(
-        self, file_path: str, file_name: str, content_type: str = None
+        self,
+        file_path: str,
+        file_name: str,
+        content_type: str = None,
+        sha1_sum: str = None,
+        file_hash: str = None,
     ) -> dict:
+        # digests computed at upload time skip another read of the file here and in b2sdk
         try:
-            file_hash = self._calculate_file_hash(file_path)
+            if not file_hash:
+                file_hash = self._calculate_file_hash(file_path)
 
             file_info = self.bucket.upload_local_file(
-                local_file=file_path, file_name=file_name, content_type=content_type
+                local_file=file_path,
+                file_name=file_name,
+                content_type=content_type,
+                sha1_sum=sha1_sum,
             )
 
             download_url = self.api.get_download_url_for_fileid(file_info.id_)
@@ -63,6 +74,13 @@ class B2Client:
     def get_download_url(self, file_id: str) -> str:
         return self.api.get_download_url_for_fileid(file_id)
 
+    def download_file(self, file_id: str, destination_path: str) -> None:
+        self.bucket.download_file_by_id(file_id).save_to(destination_path)
+
+    def probe(self) -> None:
+        # one list call against the bucket, raises if B2 is unreachable
+        next(iter(self.bucket.ls(fetch_count=1)), None)
+
     def _calculate_file_hash(self, file_path: str) -> str:
         sha256_hash = hashlib.sha256()
         with open(file_path, "rb") as f:
@@ -1,12 +1,112 @@
-from sqlalchemy import create_engine, MetaData
+import itertools
+import time
+from sqlalchemy import create_engine, event, MetaData
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import SQLAlchemyError, TimeoutError as PoolTimeoutError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
+from prometheus_client import Counter, Gauge, Histogram
 from app.config import settings
+import structlog
 
-engine = create_engine(settings.database_url)
+logger = structlog.get_logger(__name__)
+
+POOL_CHECKOUTS = Counter(
+    "db_pool_checkouts_total", "Connections checked out of the pool", ["engine"]
+)
+POOL_WAIT = Histogram(
+    "db_pool_wait_seconds", "Time spent waiting for a pooled connection", ["engine"]
+)
+POOL_IN_USE = Gauge("db_pool_checked_out", "Connections currently in use", ["engine"])
+
+
+class InstrumentedQueuePool(QueuePool):
+    engine_label = "primary"
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            POOL_WAIT.labels(self.engine_label).observe(time.perf_counter() - start)
+
+
+def create_db_engine(url: str, label: str, pool_size: int, max_overflow: int):
+    if url.startswith("sqlite") and ":memory:" in url:
+        return create_engine(url)
+
+    # subclass per engine so the label survives pool.recreate() on dispose
+    pool_class = type(
+        f"{label.title()}QueuePool", (InstrumentedQueuePool,), {"engine_label": label}
+    )
+    db_engine = create_engine(
+        url,
+        poolclass=pool_class,
+        pool_size=pool_size,
+        max_overflow=max_overflow,
+        pool_timeout=settings.db_pool_timeout,
+        pool_recycle=settings.db_pool_recycle,
+        pool_pre_ping=settings.db_pool_pre_ping,
+    )
+
+    @event.listens_for(db_engine, "checkout")
+    def on_checkout(dbapi_connection, connection_record, connection_proxy):
+        POOL_CHECKOUTS.labels(label).inc()
+        POOL_IN_USE.labels(label).inc()
+
+    @event.listens_for(db_engine, "checkin")
+    def on_checkin(dbapi_connection, connection_record):
+        POOL_IN_USE.labels(label).dec()
+
+    return db_engine
+
+
+engine = create_db_engine(
+    settings.database_url, "primary", settings.db_pool_size, settings.db_max_overflow
+)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
+replica_sessions = [
+    sessionmaker(
+        autocommit=False,
+        autoflush=False,
+        bind=create_db_engine(
+            url, f"replica{i}", settings.db_pool_size, settings.db_max_overflow
+        ),
+    )
+    for i, url in enumerate(settings.replica_database_urls)
+]
+replica_rotation = itertools.count()
+replica_down_until = {}
+
+
+def open_read_session():
+    # round-robin over healthy read replicas, the primary when none can connect
+    if replica_sessions:
+        offset = next(replica_rotation)
+        for i in range(len(replica_sessions)):
+            index = (offset + i) % len(replica_sessions)
+            if replica_down_until.get(index, 0) > time.monotonic():
+                continue
+
+            db = replica_sessions[index]()
+            try:
+                db.connection()
+                return db
+            except SQLAlchemyError as e:
+                # pool timeouts are not DBAPIErrors, a busy replica is skipped this
+                # once while a broken one is left alone for replica_retry_after
+                db.close()
+                if not isinstance(e, PoolTimeoutError):
+                    replica_down_until[index] = (
+                        time.monotonic() + settings.replica_retry_after
+                    )
+                logger.warning("Read replica unavailable", replica=index, error=str(e))
+
+    return SessionLocal()
+
 
 def get_db():
     db = SessionLocal()
@@ -14,3 +114,21 @@ def get_db():
         yield db
     finally:
         db.close()
+
+
+def get_read_db():
+    db = open_read_session()
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+def dialect_insert(db):
+    # INSERT construct with ON CONFLICT support for the session's database
+    dialect = db.get_bind().dialect.name
+    if dialect == "postgresql":
+        return postgresql.insert
+    if dialect == "sqlite":
+        return sqlite.insert
+    raise NotImplementedError(f"Upsert not supported for {dialect}")
@@ -0,0 +1,66 @@
+import os
+from typing import Optional
+from fastapi import HTTPException
+
+# leading bytes for each allowed binary format; zip-based .docx only gets the zip header
+MAGIC_NUMBERS = {
+    ".jpg": [b"\xff\xd8\xff"],
+    ".jpeg": [b"\xff\xd8\xff"],
+    ".png": [b"\x89PNG\r\n\x1a\n"],
+    ".gif": [b"GIF87a", b"GIF89a"],
+    ".pdf": [b"%PDF-"],
+    ".doc": [b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1"],
+    ".docx": [b"PK\x03\x04"],
+}
+
+TEXT_EXTENSIONS = {".txt"}
+
+CONTENT_TYPES = {
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".png": "image/png",
+    ".gif": "image/gif",
+    ".pdf": "application/pdf",
+    ".txt": "text/plain",
+    ".doc": "application/msword",
+    ".docx": "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+}
+
+TEXT_CONTROL_BYTES = bytes(set(range(32)) - {8, 9, 10, 12, 13})
+
+
+def looks_like_text(head: bytes) -> bool:
+    if b"\x00" in head:
+        return False
+    try:
+        head.decode("utf-8")
+        return True
+    except UnicodeDecodeError as e:
+        # the head may cut a multi-byte character in half
+        if e.reason == "unexpected end of data":
+            return True
+    # legacy 8-bit encodings still have no control characters
+    return not any(byte in TEXT_CONTROL_BYTES for byte in head)
+
+
+def matches_extension(ext: str, head: bytes) -> bool:
+    if ext in TEXT_EXTENSIONS:
+        return looks_like_text(head)
+    if ext in MAGIC_NUMBERS:
+        return head.startswith(tuple(MAGIC_NUMBERS[ext]))
+    # allowed extensions without a known signature are accepted as-is
+    return True
+
+
+def validate_head(filename: Optional[str], head: bytes, allowed_extensions) -> str:
+    # returns the content type implied by the checked extension, never the client's
+    ext = os.path.splitext(filename or "")[1].lower()
+    if ext not in allowed_extensions:
+        raise HTTPException(status_code=400, detail="File type not allowed")
+
+    if not matches_extension(ext, head):
+        raise HTTPException(
+            status_code=415, detail="File content does not match its extension"
+        )
+
+    return CONTENT_TYPES.get(ext, "application/octet-stream")
@@ -0,0 +1,56 @@
+import asyncio
+import hashlib
+import os
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO, Optional
+from app.config import settings
+
+# hashlib releases the GIL on large buffers, so digests run in parallel across threads
+hash_executor = ThreadPoolExecutor(
+    max_workers=settings.hash_workers, thread_name_prefix="hash"
+)
+
+
+def compute_digests(source: BinaryIO, copy_to: Optional[str] = None) -> dict:
+    # one pass over the upload: sha256 for dedup, sha1 for B2, crc32 for cache keys,
+    # optionally writing the bytes to copy_to as they are read
+    sha256 = hashlib.sha256()
+    sha1 = hashlib.sha1()
+    crc32 = 0
+    size = 0
+
+    source.seek(0)
+    target = open(copy_to, "wb") if copy_to else None
+    try:
+        for chunk in iter(lambda: source.read(settings.hash_chunk_size), b""):
+            sha256.update(chunk)
+            sha1.update(chunk)
+            if settings.compute_fast_hash:
+                crc32 = zlib.crc32(chunk, crc32)
+            if target:
+                target.write(chunk)
+            size += len(chunk)
+    except Exception:
+        if target:
+            target.close()
+            os.remove(copy_to)
+        raise
+    finally:
+        if target and not target.closed:
+            target.close()
+        source.seek(0)
+
+    return {
+        "sha256": sha256.hexdigest(),
+        "sha1": sha1.hexdigest(),
+        "crc32": f"{crc32:08x}" if settings.compute_fast_hash else None,
+        "size": size,
+    }
+
+
+async def compute_digests_async(
+    source: BinaryIO, copy_to: Optional[str] = None
+) -> dict:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(hash_executor, compute_digests, source, copy_to)
@@ -0,0 +1,330 @@
+import os
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import update, delete, text
+from sqlalchemy.sql import func
+from app.models import FileRecord, StoredObject, FileReplica
+from app.b2_client import b2_client
+from app.config import settings
+from app.storage import PRIMARY_BACKEND, COLD_BACKEND, get_backend
+from app.tasks import (
+    celery,
+    SessionLocal,
+    worker_engine,
+    update_shared_records,
+    enqueue_replication,
+    delete_backend_objects,
+)
+import structlog
+
+logger = structlog.get_logger(__name__)
+
+
+def release_stored_object(db, file_record: FileRecord) -> list[tuple[str, str, str]]:
+    # returns the (backend, file_id, file_name) objects to delete once the last
+    # reference is gone
+    remaining = db.execute(
+        update(StoredObject)
+        .where(StoredObject.file_hash == file_record.file_hash)
+        .values(ref_count=StoredObject.ref_count - 1, updated_at=func.now())
+        .returning(StoredObject.ref_count)
+    ).scalar()
+
+    if remaining is None or remaining > 0:
+        return []
+
+    released = db.execute(
+        delete(StoredObject)
+        .where(
+            StoredObject.file_hash == file_record.file_hash,
+            StoredObject.ref_count <= 0,
+        )
+        .returning(
+            StoredObject.b2_file_id,
+            StoredObject.b2_file_name,
+            StoredObject.cold_file_id,
+            StoredObject.cold_file_name,
+        )
+    ).first()
+    if not released:
+        return []
+
+    objects = remove_replicas(db, file_record.file_hash)
+    if released.b2_file_id:
+        objects.append((PRIMARY_BACKEND, released.b2_file_id, released.b2_file_name))
+    if released.cold_file_id:
+        objects.append((COLD_BACKEND, released.cold_file_id, released.cold_file_name))
+    return objects
+
+
+def remove_replicas(db, file_hash: str) -> list[tuple[str, str, str]]:
+    replicas = db.execute(
+        delete(FileReplica)
+        .where(FileReplica.file_hash == file_hash)
+        .returning(
+            FileReplica.backend,
+            FileReplica.remote_file_id,
+            FileReplica.remote_file_name,
+        )
+    ).all()
+    return [tuple(replica) for replica in replicas if replica.remote_file_id]
+
+
+def temp_path_for(file_hash: str) -> str:
+    os.makedirs(settings.temp_upload_dir, exist_ok=True)
+    return os.path.join(settings.temp_upload_dir, f"lifecycle-{file_hash}")
+
+
+def tiering_candidate(cutoff: datetime):
+    # hot, fully uploaded, still referenced and not downloaded since cutoff
+    return (
+        StoredObject.storage_tier == "hot",
+        StoredObject.upload_status == "completed",
+        StoredObject.b2_file_id.isnot(None),
+        StoredObject.ref_count > 0,
+        func.coalesce(StoredObject.last_accessed_at, StoredObject.created_at) < cutoff,
+    )
+
+
+def move_to_cold(db, stored_id: int, cutoff: datetime) -> bool:
+    file_hash, hot_file_id, hot_file_name = (
+        db.query(
+            StoredObject.file_hash, StoredObject.b2_file_id, StoredObject.b2_file_name
+        )
+        .filter(StoredObject.id == stored_id)
+        .one()
+    )
+    # no transaction stays open across the slow copy
+    db.rollback()
+
+    temp_path = temp_path_for(file_hash)
+    try:
+        get_backend(PRIMARY_BACKEND).download_file(
+            hot_file_id, hot_file_name, temp_path
+        )
+        result = get_backend(COLD_BACKEND).upload_file(temp_path, hot_file_name)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    cold_object = (COLD_BACKEND, result["file_id"], result["file_name"])
+
+    try:
+        # uploads and purges of this hash wait on the row lock until we commit
+        stored = (
+            db.query(StoredObject)
+            .filter(
+                StoredObject.id == stored_id,
+                StoredObject.b2_file_id == hot_file_id,
+                *tiering_candidate(cutoff),
+            )
+            .with_for_update()
+            .populate_existing()
+            .first()
+        )
+        if stored:
+            # stored object first, records created after this copy its archived state
+            stored.cold_file_id = result["file_id"]
+            stored.cold_file_name = result["file_name"]
+            stored.storage_tier = "cold"
+            stored.upload_status = "archived"
+            stored.b2_file_id = None
+            stored.b2_file_name = None
+            stored.public_url = None
+            db.flush()
+
+            db.query(FileRecord).filter(FileRecord.file_hash == file_hash).update(
+                {
+                    "b2_file_id": None,
+                    "b2_file_name": None,
+                    "public_url": None,
+                    "upload_status": "archived",
+                },
+                synchronize_session=False,
+            )
+            hot_objects = remove_replicas(db, file_hash)
+            hot_objects.append((PRIMARY_BACKEND, hot_file_id, hot_file_name))
+            db.commit()
+
+    except Exception:
+        # the cold copy is only referenced once the commit lands
+        db.rollback()
+        delete_backend_objects([cold_object])
+        raise
+
+    if not stored:
+        db.rollback()
+        logger.info("Stored object changed while tiering", file_hash=file_hash)
+        delete_backend_objects([cold_object])
+        return False
+
+    delete_backend_objects(hot_objects)
+    return True
+
+
+@celery.task
+def tier_cold_files():
+    if not settings.cold_backend:
+        return 0
+
+    cutoff = datetime.now(timezone.utc) - timedelta(days=settings.cold_after_days)
+    db = SessionLocal()
+    moved = 0
+    try:
+        candidates = [
+            stored_id
+            for (stored_id,) in db.query(StoredObject.id)
+            .filter(*tiering_candidate(cutoff))
+            .order_by(StoredObject.id)
+            .limit(settings.lifecycle_batch_size)
+        ]
+        for stored_id in candidates:
+            try:
+                moved += move_to_cold(db, stored_id, cutoff)
+            except Exception as e:
+                db.rollback()
+                logger.error(
+                    "Moving file to cold storage failed",
+                    stored_object_id=stored_id,
+                    error=str(e),
+                )
+
+        logger.info("Cold storage tiering finished", moved=moved)
+        return moved
+    finally:
+        db.close()
+
+
+@celery.task(bind=True, max_retries=3)
+def restore_file(self, file_hash: str):
+    db = SessionLocal()
+    try:
+        try:
+            stored = (
+                db.query(StoredObject)
+                .filter(StoredObject.file_hash == file_hash)
+                .first()
+            )
+            if not stored or stored.storage_tier != "cold":
+                return
+
+            temp_path = temp_path_for(file_hash)
+            get_backend(COLD_BACKEND).download_file(
+                stored.cold_file_id, stored.cold_file_name, temp_path
+            )
+            content_type = (
+                db.query(FileRecord.content_type)
+                .filter(FileRecord.file_hash == file_hash)
+                .limit(1)
+                .scalar()
+            )
+            b2_result = b2_client.upload_file(
+                temp_path, stored.cold_file_name, content_type
+            )
+
+            cold_object = (COLD_BACKEND, stored.cold_file_id, stored.cold_file_name)
+
+            # a redelivered restore may have finished first, only one copy is kept
+            stored = (
+                db.query(StoredObject)
+                .filter(
+                    StoredObject.id == stored.id,
+                    StoredObject.storage_tier == "cold",
+                    StoredObject.cold_file_id == cold_object[1],
+                )
+                .with_for_update()
+                .populate_existing()
+                .first()
+            )
+            if not stored:
+                db.rollback()
+                b2_client.delete_file(
+                    b2_result["b2_file_id"], b2_result["b2_file_name"]
+                )
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+                return
+
+            update_shared_records(
+                db,
+                file_hash,
+                b2_file_id=b2_result["b2_file_id"],
+                b2_file_name=b2_result["b2_file_name"],
+                public_url=b2_result["public_url"],
+                upload_status="completed",
+            )
+            stored.storage_tier = "hot"
+            stored.cold_file_id = None
+            stored.cold_file_name = None
+            stored.last_accessed_at = datetime.now(timezone.utc)
+            if settings.replica_backends:
+                enqueue_replication(db, file_hash, temp_path)
+            db.commit()
+
+        except Exception as e:
+            logger.error("File restore failed", file_hash=file_hash, error=str(e))
+            db.rollback()
+
+            # put the object back to archived so the next access can ask again
+            if self.request.retries >= self.max_retries:
+                update_shared_records(db, file_hash, upload_status="archived")
+                db.commit()
+                return
+            raise self.retry(countdown=60 * (2**self.request.retries))
+
+        # the restore is committed, cleanup failures must not send it back to cold
+        delete_backend_objects([cold_object])
+
+        if not settings.replica_backends and os.path.exists(temp_path):
+            os.remove(temp_path)
+
+        logger.info("File restored from cold storage", file_hash=file_hash)
+
+    finally:
+        db.close()
+
+
+@celery.task
+def purge_deleted_files():
+    now = datetime.now(timezone.utc)
+    cutoff = now - timedelta(days=settings.deleted_grace_days)
+    db = SessionLocal()
+    purged = 0
+    try:
+        # rows soft-deleted before deleted_at existed start their grace period now
+        db.query(FileRecord).filter(
+            FileRecord.is_deleted.is_(True), FileRecord.deleted_at.is_(None)
+        ).update({"deleted_at": now}, synchronize_session=False)
+        db.commit()
+
+        records = (
+            db.query(FileRecord)
+            .filter(FileRecord.is_deleted.is_(True), FileRecord.deleted_at < cutoff)
+            .order_by(FileRecord.id)
+            .limit(settings.lifecycle_batch_size)
+            .all()
+        )
+        for record in records:
+            released = release_stored_object(db, record)
+            db.delete(record)
+            db.commit()
+            delete_backend_objects(released)
+            purged += 1
+
+        logger.info("Purged deleted files", purged=purged)
+        return purged
+    finally:
+        db.close()
+
+
+@celery.task
+def compact_files_table():
+    # plain VACUUM reclaims dead rows left by purges without locking out readers
+    with worker_engine.connect().execution_options(
+        isolation_level="AUTOCOMMIT"
+    ) as conn:
+        if worker_engine.dialect.name == "postgresql":
+            for table in (FileRecord.__tablename__, StoredObject.__tablename__):
+                conn.execute(text(f"VACUUM (ANALYZE) {table}"))
+        elif worker_engine.dialect.name == "sqlite":
+            conn.execute(text("VACUUM"))
+
+    logger.info("Compacted files table")
@@ -1,14 +1,18 @@
 from fastapi import FastAPI, UploadFile, File, Depends, HTTPException, Query
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+from pydantic_core import to_json
 from sqlalchemy.orm import Session
 from typing import Optional
 import structlog
 
-from app.database import get_db, engine
+from app.database import get_db, get_read_db, engine
 from app.models import Base
-from app.schemas import FileUploadResponse, FileInfo, FileListResponse
+from app.schemas import FileUploadResponse, FileInfo, FileListResponse, ReplicaInfo
 from app.services import FileService
 from app.config import settings
+from app.middleware import UploadGuardMiddleware
 
 Base.metadata.create_all(bind=engine)
 
@@ -23,6 +27,7 @@ app = FastAPI(
     version="1.0.0",
 )
 
+app.add_middleware(UploadGuardMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],  # change this depending on the environemnt you use
@@ -37,6 +42,11 @@ async def health_check():
     return {"status": "healthy", "service": "file-upload-service"}
 
 
+@app.get("/metrics")
+async def metrics():
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
 @app.post("/upload", response_model=FileUploadResponse)
 async def upload_file(
     file: UploadFile = File(...),
@@ -55,29 +65,27 @@ async def upload_file(
             public_url=file_record.public_url,
             created_at=file_record.created_at,
         )
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.get("/files/export")
+async def export_files(uploaded_by: Optional[str] = None):
+    return StreamingResponse(
+        FileService.export_files(uploaded_by), media_type="application/x-ndjson"
+    )
+
+
+# read endpoints return pre-serialized JSON, response_model only documents the shape
 @app.get("/files/{file_id}", response_model=FileInfo)
-async def get_file(file_id: int, db: Session = Depends(get_db)):
-    file_record = FileService.get_file_by_id(db, file_id)
-    if not file_record:
+async def get_file(file_id: int, db: Session = Depends(get_read_db)):
+    file_info = FileService.get_file_info(db, file_id)
+    if not file_info:
         raise HTTPException(status_code=404, detail="File not found")
 
-    return FileInfo(
-        id=file_record.id,
-        filename=file_record.filename,
-        original_filename=file_record.original_filename,
-        file_size=file_record.file_size,
-        content_type=file_record.content_type,
-        file_hash=file_record.file_hash,
-        upload_status=file_record.upload_status,
-        created_at=file_record.created_at,
-        updated_at=file_record.updated_at,
-        uploaded_by=file_record.uploaded_by,
-        public_url=file_record.public_url,
-    )
+    return Response(content=to_json(file_info), media_type="application/json")
 
 
 @app.get("/files", response_model=FileListResponse)
@@ -85,29 +93,13 @@ async def list_files(
     page: int = Query(1, ge=1),
     size: int = Query(50, ge=1, le=100),
     uploaded_by: Optional[str] = None,
-    db: Session = Depends(get_db),
+    db: Session = Depends(get_read_db),
 ):
     skip = (page - 1) * size
     files, total = FileService.list_files(db, skip, size, uploaded_by)
 
-    file_infos = [
-        FileInfo(
-            id=f.id,
-            filename=f.filename,
-            original_filename=f.original_filename,
-            file_size=f.file_size,
-            content_type=f.content_type,
-            file_hash=f.file_hash,
-            upload_status=f.upload_status,
-            created_at=f.created_at,
-            updated_at=f.updated_at,
-            uploaded_by=f.uploaded_by,
-            public_url=f.public_url,
-        )
-        for f in files
-    ]
-
-    return FileListResponse(files=file_infos, total=total, page=page, size=size)
+    content = to_json({"files": files, "total": total, "page": page, "size": size})
+    return Response(content=content, media_type="application/json")
 
 
 @app.delete("/files/{file_id}")
@@ -123,10 +115,30 @@ async def delete_file(file_id: int, db: Session = Depends(get_db)):
 async def get_download_url(file_id: int, db: Session = Depends(get_db)):
 
     file_record = FileService.get_file_by_id(db, file_id)
-    if not file_record or not file_record.public_url:
+    if file_record and file_record.upload_status in ("archived", "restoring"):
+        FileService.request_restore(db, file_record)
+        return JSONResponse(
+            status_code=202,
+            content={"status": "restoring", "detail": "File is being restored"},
+        )
+
+    download_url = (
+        FileService.get_download_url(db, file_record) if file_record else None
+    )
+    if not download_url:
         raise HTTPException(status_code=404, detail="File not found or not uploaded")
 
-    return {"download_url": file_record.public_url}
+    FileService.record_access(db, file_record)
+    return {"download_url": download_url}
+
+
+@app.get("/files/{file_id}/replicas", response_model=list[ReplicaInfo])
+async def get_replicas(file_id: int, db: Session = Depends(get_read_db)):
+    file_record = FileService.get_file_by_id(db, file_id)
+    if not file_record:
+        raise HTTPException(status_code=404, detail="File not found")
+
+    return FileService.get_replicas(db, file_record)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,112 @@
+import re
+from typing import Optional
+from fastapi import HTTPException
+from fastapi.responses import JSONResponse
+from starlette.datastructures import Headers
+from app.config import settings
+from app.file_types import validate_head
+
+BOUNDARY_RE = re.compile(rb'boundary="?([^";]+)"?', re.IGNORECASE)
+FILENAME_RE = re.compile(rb'filename="([^"]*)"', re.IGNORECASE)
+
+# stop looking for the file part if its headers are not within this many bytes
+MAX_PART_HEADER_SEARCH = 64 * 1024
+
+
+def find_file_head(body: bytes, boundary: bytes, complete: bool):
+    # (filename, head) once the file part can be sniffed, None while more bytes
+    # are needed, False when the body has no file part to check
+    parts = body.split(b"--" + boundary)[1:]
+    for index, part in enumerate(parts):
+        header_end = part.find(b"\r\n\r\n")
+        if header_end == -1:
+            break
+
+        match = FILENAME_RE.search(part[:header_end])
+        if not match:
+            continue
+
+        data_start = header_end + 4
+        data = part[data_start:]
+        part_complete = complete or index < len(parts) - 1
+        if part_complete and data.endswith(b"\r\n"):
+            data = data[:-2]
+        if len(data) >= settings.sniff_bytes or part_complete:
+            filename = match.group(1).decode("utf-8", "replace")
+            return filename, data[: settings.sniff_bytes]
+        return None
+
+    if complete or len(body) > MAX_PART_HEADER_SEARCH:
+        return False
+    return None
+
+
+class UploadGuardMiddleware:
+    # checks Content-Length and the head of the file part before the rest of the
+    # body is read, then replays the buffered messages to the app while counting bytes
+
+    def __init__(self, app, path: str = "/upload"):
+        self.app = app
+        self.path = path
+        self.max_body_size = settings.max_file_size + settings.max_request_overhead
+
+    async def __call__(self, scope, receive, send):
+        if (
+            scope["type"] != "http"
+            or scope["method"] != "POST"
+            or scope["path"] != self.path
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        headers = Headers(scope=scope)
+        content_length = headers.get("content-length")
+        if content_length and content_length.isdigit():
+            if int(content_length) > self.max_body_size:
+                await self.reject(scope, receive, send, 413, "File too large")
+                return
+
+        boundary = BOUNDARY_RE.search(headers.get("content-type", "").encode())
+        buffered = []
+        if boundary:
+            body = b""
+            more_body = True
+            result = None
+            while more_body and result is None:
+                message = await receive()
+                buffered.append(message)
+                if message["type"] != "http.request":
+                    break
+                body += message.get("body", b"")
+                more_body = message.get("more_body", False)
+                result = find_file_head(body, boundary.group(1), not more_body)
+
+            if result:
+                filename, head = result
+                try:
+                    validate_head(filename, head, settings.allowed_extensions)
+                except HTTPException as e:
+                    await self.reject(scope, receive, send, e.status_code, e.detail)
+                    return
+
+        await self.app(scope, self.replay(buffered, receive), send)
+
+    def replay(self, buffered: list, receive):
+        received = 0
+
+        async def wrapped_receive():
+            nonlocal received
+            message = buffered.pop(0) if buffered else await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_body_size:
+                    raise HTTPException(status_code=413, detail="File too large")
+            return message
+
+        return wrapped_receive
+
+    async def reject(
+        self, scope, receive, send, status_code: int, detail: Optional[str]
+    ):
+        response = JSONResponse({"detail": detail}, status_code=status_code)
+        await response(scope, receive, send)
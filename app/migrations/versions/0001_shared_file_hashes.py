@@ -0,0 +1,132 @@
+"""shared content hashes, lifecycle and digest columns on files
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-19
+
+Databases created before deduplication moved to stored_objects still carry
+unique constraints on files.file_hash and files.b2_file_id, which turn every
+duplicate upload into an IntegrityError. They also lack the columns added to
+FileRecord since, and a stored_objects row for the content they already hold.
+Each step checks the live schema or data, so databases already created from the
+current models are left as they are.
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision: str = "0001"
+down_revision: Union[str, Sequence[str], None] = None
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# names SQLite's unnamed inline UNIQUE constraints so batch mode can drop them
+NAMING_CONVENTION = {"uq": "uq_%(table_name)s_%(column_0_name)s"}
+SHARED_COLUMNS = (["file_hash"], ["b2_file_id"])
+NEW_COLUMNS = {
+    # purge_deleted_files measures the grace period from here
+    "deleted_at": sa.DateTime(timezone=True),
+    # digests computed alongside sha256 in the upload's single hashing pass
+    "sha1_hash": sa.String(40),
+    "crc32": sa.String(8),
+}
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    inspector = sa.inspect(op.get_bind())
+    if not inspector.has_table("files"):
+        # fresh database, create_all builds files from the current models
+        return
+
+    unique_constraints = [
+        constraint
+        for constraint in inspector.get_unique_constraints("files")
+        if constraint["column_names"] in SHARED_COLUMNS
+    ]
+    unique_indexes = [
+        index
+        for index in inspector.get_indexes("files")
+        if index["unique"] and index["column_names"] in SHARED_COLUMNS
+    ]
+    existing_columns = {column["name"] for column in inspector.get_columns("files")}
+    new_columns = [name for name in NEW_COLUMNS if name not in existing_columns]
+    if unique_constraints or unique_indexes or new_columns:
+        with op.batch_alter_table(
+            "files", naming_convention=NAMING_CONVENTION
+        ) as batch:
+            for name in new_columns:
+                batch.add_column(sa.Column(name, NEW_COLUMNS[name]))
+            for constraint in unique_constraints:
+                name = constraint["name"] or f"uq_files_{constraint['column_names'][0]}"
+                batch.drop_constraint(name, type_="unique")
+            for index in unique_indexes:
+                # ix_files_file_hash stays, lookups by hash still need it
+                batch.drop_index(index["name"])
+                batch.create_index(index["name"], index["column_names"])
+
+    if not inspector.has_table("stored_objects"):
+        create_stored_objects()
+    backfill_stored_objects()
+
+
+def create_stored_objects() -> None:
+    # as StoredObject was when this revision was written, create_all skips it later
+    op.create_table(
+        "stored_objects",
+        sa.Column("id", sa.Integer(), primary_key=True, index=True),
+        sa.Column("file_hash", sa.String(64), unique=True, nullable=False),
+        sa.Column("ref_count", sa.Integer(), nullable=False, default=1),
+        sa.Column("b2_file_id", sa.String(255), unique=True),
+        sa.Column("b2_file_name", sa.String(255)),
+        sa.Column("public_url", sa.String(500)),
+        sa.Column("upload_status", sa.String(20)),
+        sa.Column("storage_tier", sa.String(20)),
+        sa.Column("cold_file_id", sa.String(255)),
+        sa.Column("cold_file_name", sa.String(255)),
+        sa.Column(
+            "last_accessed_at", sa.DateTime(timezone=True), server_default=sa.func.now()
+        ),
+        sa.Column(
+            "created_at", sa.DateTime(timezone=True), server_default=sa.func.now()
+        ),
+        sa.Column("updated_at", sa.DateTime(timezone=True)),
+    )
+
+
+def backfill_stored_objects() -> None:
+    # files uploaded before deduplication own their B2 object outright, hand it to
+    # a stored object counting every row (soft-deleted ones too, purge releases
+    # them) so later duplicates and purges share it instead of uploading again
+    op.execute("""
+        INSERT INTO stored_objects (
+            file_hash, ref_count, b2_file_id, b2_file_name, public_url,
+            upload_status, storage_tier
+        )
+        SELECT
+            files.file_hash, COUNT(*), MAX(files.b2_file_id),
+            MAX(files.b2_file_name), MAX(files.public_url),
+            MAX(files.upload_status), 'hot'
+        FROM files
+        WHERE files.file_hash IS NOT NULL
+          AND NOT EXISTS (
+            SELECT 1 FROM stored_objects
+            WHERE stored_objects.file_hash = files.file_hash
+          )
+        GROUP BY files.file_hash
+        """)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    # stored_objects stays, the running code keeps it in step with files
+    # fails while duplicate hashes exist, purge them before downgrading
+    with op.batch_alter_table("files", naming_convention=NAMING_CONVENTION) as batch:
+        for name in NEW_COLUMNS:
+            batch.drop_column(name)
+        batch.drop_index("ix_files_file_hash")
+        batch.create_index("ix_files_file_hash", ["file_hash"], unique=True)
+        batch.create_unique_constraint("uq_files_b2_file_id", ["b2_file_id"])
@@ -1,4 +1,14 @@
-from sqlalchemy import Column, Integer, String, DateTime, BigInteger, Boolean, Text
+from sqlalchemy import (
+    Column,
+    Integer,
+    String,
+    DateTime,
+    BigInteger,
+    Boolean,
+    Text,
+    Float,
+    UniqueConstraint,
+)
 from sqlalchemy.sql import func
 from app.database import Base
 
@@ -11,8 +21,10 @@ class FileRecord(Base):
     original_filename = Column(String(255), nullable=False)
     file_size = Column(BigInteger, nullable=False)
     content_type = Column(String(100))
-    file_hash = Column(String(64), unique=True, index=True)
-    b2_file_id = Column(String(255), unique=True)
+    file_hash = Column(String(64), index=True)  # shared with StoredObject.file_hash
+    sha1_hash = Column(String(40))  # sent to B2 so it can verify the upload
+    crc32 = Column(String(8))  # fast non-cryptographic digest for cache keys
+    b2_file_id = Column(String(255))
     b2_file_name = Column(String(255))
     upload_status = Column(String(20), default="pending")
     created_at = Column(DateTime(timezone=True), server_default=func.now())
@@ -21,3 +33,62 @@ class FileRecord(Base):
     file_metadata = Column(Text)  # store additional json metadata here
     public_url = Column(String(500))
     is_deleted = Column(Boolean, default=False)
+    deleted_at = Column(DateTime(timezone=True))
+
+
+class StoredObject(Base):
+    # one row per distinct content hash, shared by every FileRecord with that hash
+    __tablename__ = "stored_objects"
+
+    id = Column(Integer, primary_key=True, index=True)
+    file_hash = Column(String(64), unique=True, nullable=False)
+    ref_count = Column(Integer, nullable=False, default=1)
+    b2_file_id = Column(String(255), unique=True)
+    b2_file_name = Column(String(255))
+    public_url = Column(String(500))
+    upload_status = Column(String(20), default="pending")
+    storage_tier = Column(String(20), default="hot")  # hot (B2 primary) or cold
+    cold_file_id = Column(String(255))
+    cold_file_name = Column(String(255))
+    last_accessed_at = Column(DateTime(timezone=True), server_default=func.now())
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    updated_at = Column(DateTime(timezone=True), onupdate=func.now())
+
+
+class FileReplica(Base):
+    # copy of a stored object on one of the configured replica backends
+    __tablename__ = "file_replicas"
+    __table_args__ = (UniqueConstraint("file_hash", "backend"),)
+
+    id = Column(Integer, primary_key=True, index=True)
+    file_hash = Column(String(64), index=True, nullable=False)
+    backend = Column(String(50), nullable=False)
+    status = Column(String(20), default="pending")
+    remote_file_id = Column(String(255))
+    remote_file_name = Column(String(255))
+    public_url = Column(String(500))
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    updated_at = Column(DateTime(timezone=True), onupdate=func.now())
+
+
+class BackendProbe(Base):
+    # latest latency probe per storage backend, used to route downloads
+    __tablename__ = "backend_probes"
+
+    backend = Column(String(50), primary_key=True)
+    latency_ms = Column(Float)
+    is_healthy = Column(Boolean, default=False)
+    probed_at = Column(DateTime(timezone=True))
+
+
+class OutboxMessage(Base):
+    # Celery task written in the same transaction as the rows it refers to
+    __tablename__ = "outbox"
+
+    id = Column(Integer, primary_key=True, index=True)
+    task_name = Column(String(255), nullable=False)
+    payload = Column(Text, nullable=False)  # json encoded task args
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    sent_at = Column(DateTime(timezone=True), index=True)
+    attempts = Column(Integer, default=0)
+    last_error = Column(Text)
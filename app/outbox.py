@@ -0,0 +1,111 @@
+import json
+import time
+from datetime import datetime, timedelta, timezone
+from kombu.exceptions import OperationalError
+from sqlalchemy.orm import Session
+from app.config import settings
+from app.models import OutboxMessage
+from app.tasks import celery, SessionLocal
+import structlog
+
+logger = structlog.get_logger(__name__)
+
+
+def enqueue(db: Session, task, *args) -> OutboxMessage:
+    # added to the caller's transaction, nothing is sent until it commits
+    message = OutboxMessage(task_name=task.name, payload=json.dumps(args))
+    db.add(message)
+    return message
+
+
+def relay_batch(db: Session, batch_size: int = None) -> int:
+    messages = (
+        db.query(OutboxMessage)
+        .filter(
+            OutboxMessage.sent_at.is_(None),
+            OutboxMessage.attempts < settings.outbox_max_attempts,
+        )
+        # messages that failed before go last, one bad row cannot hold up the rest
+        .order_by(OutboxMessage.attempts, OutboxMessage.id)
+        .limit(batch_size or settings.outbox_batch_size)
+        .with_for_update(skip_locked=True)
+        .all()
+    )
+    if not messages:
+        db.rollback()
+        return 0
+
+    sent = 0
+    try:
+        # one broker connection for the whole batch
+        with celery.producer_or_acquire() as producer:
+            for message in messages:
+                try:
+                    celery.send_task(
+                        message.task_name,
+                        args=json.loads(message.payload),
+                        producer=producer,
+                    )
+                except (OperationalError, ConnectionError):
+                    # the broker is down, not the message: the relay backs off
+                    raise
+                except Exception as e:
+                    record_failure(message, e)
+                    continue
+                message.sent_at = datetime.now(timezone.utc)
+                sent += 1
+    finally:
+        db.commit()
+
+    return sent
+
+
+def record_failure(message: OutboxMessage, error: Exception) -> None:
+    message.attempts = (message.attempts or 0) + 1
+    message.last_error = str(error)
+    if message.attempts >= settings.outbox_max_attempts:
+        # left in the table unsent for inspection, the relay skips it from now on
+        logger.error(
+            "Outbox message dead-lettered",
+            message_id=message.id,
+            task_name=message.task_name,
+            error=str(error),
+        )
+    else:
+        logger.error("Outbox publish failed", message_id=message.id, error=str(error))
+
+
+def prune_sent(db: Session) -> int:
+    cutoff = datetime.now(timezone.utc) - timedelta(
+        hours=settings.outbox_retention_hours
+    )
+    pruned = (
+        db.query(OutboxMessage)
+        .filter(OutboxMessage.sent_at < cutoff)
+        .delete(synchronize_session=False)
+    )
+    db.commit()
+    return pruned
+
+
+def run_relay() -> None:
+    logger.info("Outbox relay started", batch_size=settings.outbox_batch_size)
+    failures = 0
+    while True:
+        db = SessionLocal()
+        try:
+            sent = relay_batch(db)
+            failures = 0
+            if sent < settings.outbox_batch_size:
+                prune_sent(db)
+                time.sleep(settings.outbox_poll_interval)
+        except Exception as e:
+            failures += 1
+            logger.error("Outbox relay failed", error=str(e))
+            time.sleep(min(settings.outbox_poll_interval * 2**failures, 30))
+        finally:
+            db.close()
+
+
+if __name__ == "__main__":
+    run_relay()
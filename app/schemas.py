@@ -35,6 +35,15 @@ class FileListResponse(BaseModel):
     size: int
 
 
+class ReplicaInfo(BaseModel):
+    backend: str
+    status: str
+    public_url: Optional[str] = None
+    latency_ms: Optional[float] = None
+    is_healthy: bool = False
+    updated_at: Optional[datetime] = None
+
+
 class UploadUrlResponse(BaseModel):
     upload_url: str
     file_id: int
@@ -1,35 +1,58 @@
 import os
-import hashlib
 import uuid
-from typing import Optional, BinaryIO
+from datetime import datetime, timedelta, timezone
+from typing import Optional, BinaryIO, Iterator
 from fastapi import UploadFile, HTTPException
+from sqlalchemy import or_
 from sqlalchemy.orm import Session
-from app.models import FileRecord
-from app.b2_client import b2_client
+from sqlalchemy.sql import func
+from pydantic_core import to_json
+from app.database import open_read_session, dialect_insert
+from app.models import FileRecord, StoredObject, FileReplica, BackendProbe
 from app.config import settings
+from app.file_types import validate_head
+from app.hashing import compute_digests_async
+from app.storage import PRIMARY_BACKEND
+from app import outbox
+from app.lifecycle import restore_file
 from app.tasks import process_file_upload
 import structlog
 
 logger = structlog.get_logger(__name__)
 
+FILE_INFO_COLUMNS = (
+    FileRecord.id,
+    FileRecord.filename,
+    FileRecord.original_filename,
+    FileRecord.file_size,
+    FileRecord.content_type,
+    FileRecord.file_hash,
+    FileRecord.upload_status,
+    FileRecord.created_at,
+    FileRecord.updated_at,
+    FileRecord.uploaded_by,
+    FileRecord.public_url,
+)
+
 
 class FileService:
 
     @staticmethod
-    def validate_file(file: UploadFile) -> None:
+    def validate_file(file: UploadFile) -> str:
 
-        if hasattr(file.file, "seek") and hasattr(file.file, "tell"):
+        size = file.size
+        if size is None and hasattr(file.file, "seek") and hasattr(file.file, "tell"):
             file.file.seek(0, 2)
             size = file.file.tell()
-            file.file.seek(0)
 
-            if size > settings.max_file_size:
-                raise HTTPException(status_code=413, detail="File too large")
+        if size is not None and size > settings.max_file_size:
+            raise HTTPException(status_code=413, detail="File too large")
+
+        file.file.seek(0)
+        head = file.file.read(settings.sniff_bytes)
+        file.file.seek(0)
 
-        if file.filename:
-            ext = os.path.splitext(file.filename)[1].lower()
-            if ext not in settings.allowed_extensions:
-                raise HTTPException(status_code=400, detail="File type not allowed")
+        return validate_head(file.filename, head, settings.allowed_extensions)
 
     @staticmethod
     def generate_unique_filename(original_filename: str) -> str:
@@ -38,38 +61,95 @@ class FileService:
         return f"{unique_id}{ext}"
 
     @staticmethod
-    async def create_file_record(
-        db: Session, file: UploadFile, uploaded_by: Optional[str] = None
-    ) -> FileRecord:
-
-        content = await file.read()
-        file_hash = hashlib.sha256(content).hexdigest()
-        await file.seek(0)
-
-        existing_file = (
-            db.query(FileRecord)
-            .filter(FileRecord.file_hash == file_hash, FileRecord.is_deleted == False)
-            .first()
+    def acquire_stored_object(db: Session, file_hash: str):
+        # single INSERT ... ON CONFLICT so concurrent uploads of the same content
+        # bump ref_count instead of racing a SELECT and failing on the unique hash
+        insert = dialect_insert(db)
+        stmt = (
+            insert(StoredObject)
+            .values(file_hash=file_hash, ref_count=1, upload_status="pending")
+            .on_conflict_do_update(
+                index_elements=[StoredObject.file_hash],
+                set_={
+                    "ref_count": StoredObject.ref_count + 1,
+                    "updated_at": func.now(),
+                },
+            )
+            .returning(
+                StoredObject.ref_count,
+                StoredObject.b2_file_id,
+                StoredObject.b2_file_name,
+                StoredObject.public_url,
+                StoredObject.upload_status,
+            )
         )
+        return db.execute(stmt).one()
 
-        if existing_file:
-            logger.info(f"Duplicate file detected", file_hash=file_hash)
-            return existing_file
-
+    @staticmethod
+    async def create_file_record(
+        db: Session,
+        file: UploadFile,
+        uploaded_by: Optional[str] = None,
+        content_type: Optional[str] = None,
+    ) -> FileRecord:
         unique_filename = FileService.generate_unique_filename(file.filename)
-
-        file_record = FileRecord(
-            filename=unique_filename,
-            original_filename=file.filename,
-            file_size=len(content),
-            content_type=file.content_type,
-            file_hash=file_hash,
-            uploaded_by=uploaded_by,
-            upload_status="pending",
-        )
-
-        db.add(file_record)
-        db.commit()
+        temp_path = os.path.join(settings.temp_upload_dir, unique_filename)
+        os.makedirs(settings.temp_upload_dir, exist_ok=True)
+
+        # hashed and staged to temp_path in the thread pool, the loop keeps serving
+        digests = await compute_digests_async(file.file, temp_path)
+        file_hash = digests["sha256"]
+
+        # no awaits past this point: the transaction below must not span other requests
+        try:
+            stored = FileService.acquire_stored_object(db, file_hash)
+
+            # retrying objects still belong to the task that is backing off
+            needs_upload = stored.b2_file_id is None and (
+                stored.ref_count == 1 or stored.upload_status == "failed"
+            )
+            if needs_upload and stored.upload_status == "failed":
+                # queued again below, later duplicates wait for this upload
+                db.query(StoredObject).filter(
+                    StoredObject.file_hash == file_hash,
+                    StoredObject.upload_status == "failed",
+                ).update({"upload_status": "pending"}, synchronize_session=False)
+
+            file_record = FileRecord(
+                filename=unique_filename,
+                original_filename=file.filename,
+                file_size=digests["size"],
+                content_type=content_type or file.content_type,
+                file_hash=file_hash,
+                sha1_hash=digests["sha1"],
+                crc32=digests["crc32"],
+                uploaded_by=uploaded_by,
+                b2_file_id=stored.b2_file_id,
+                b2_file_name=stored.b2_file_name,
+                public_url=stored.public_url,
+                upload_status="pending" if needs_upload else stored.upload_status,
+            )
+            db.add(file_record)
+            db.flush()
+
+            if stored.ref_count > 1:
+                logger.info(
+                    "Duplicate file detected",
+                    file_hash=file_hash,
+                    ref_count=stored.ref_count,
+                )
+
+            if needs_upload:
+                # committed with the record, the relay publishes it to Celery
+                outbox.enqueue(db, process_file_upload, file_record.id, temp_path)
+
+            db.commit()
+        except Exception:
+            os.remove(temp_path)
+            raise
+
+        if not needs_upload:
+            os.remove(temp_path)
         db.refresh(file_record)
 
         return file_record
@@ -78,21 +158,14 @@ class FileService:
     async def upload_file_async(
         db: Session, file: UploadFile, uploaded_by: Optional[str] = None
     ) -> FileRecord:
-        FileService.validate_file(file)
+        content_type = FileService.validate_file(file)
 
-        file_record = await FileService.create_file_record(db, file, uploaded_by)
-
-        if file_record.upload_status == "completed":
-            return file_record
-
-        temp_path = os.path.join(settings.temp_upload_dir, file_record.filename)
-        os.makedirs(os.path.dirname(temp_path), exist_ok=True)
-
-        content = await file.read()
-        with open(temp_path, "wb") as f:
-            f.write(content)
+        file_record = await FileService.create_file_record(
+            db, file, uploaded_by, content_type
+        )
 
-        process_file_upload.delay(file_record.id, temp_path)
+        if file_record.upload_status == "archived":
+            FileService.request_restore(db, file_record)
 
         return file_record
 
@@ -104,19 +177,46 @@ class FileService:
             .first()
         )
 
+    @staticmethod
+    def file_info_query(db: Session, uploaded_by: Optional[str] = None):
+        # only the FileInfo columns, never the file_metadata blob or ORM identity map
+        query = db.query(*FILE_INFO_COLUMNS).filter(FileRecord.is_deleted.is_(False))
+        if uploaded_by:
+            query = query.filter(FileRecord.uploaded_by == uploaded_by)
+        return query
+
+    @staticmethod
+    def get_file_info(db: Session, file_id: int) -> Optional[dict]:
+        row = FileService.file_info_query(db).filter(FileRecord.id == file_id).first()
+        return {**row._asdict(), "metadata": None} if row else None
+
     @staticmethod
     def list_files(
         db: Session, skip: int = 0, limit: int = 100, uploaded_by: Optional[str] = None
-    ) -> tuple[list[FileRecord], int]:
-        query = db.query(FileRecord).filter(FileRecord.is_deleted == False)
+    ) -> tuple[list[dict], int]:
+        query = FileService.file_info_query(db, uploaded_by)
 
-        if uploaded_by:
-            query = query.filter(FileRecord.uploaded_by == uploaded_by)
+        total = query.with_entities(func.count(FileRecord.id)).scalar()
+        rows = query.order_by(FileRecord.id).offset(skip).limit(limit).all()
 
-        total = query.count()
-        files = query.offset(skip).limit(limit).all()
+        return [{**row._asdict(), "metadata": None} for row in rows], total
 
-        return files, total
+    @staticmethod
+    def export_files(uploaded_by: Optional[str] = None) -> Iterator[bytes]:
+        # own session: the response streams after the request's dependencies exit
+        db = open_read_session()
+        try:
+            query = FileService.file_info_query(db, uploaded_by).order_by(FileRecord.id)
+            lines = []
+            for row in query.yield_per(settings.export_batch_size):
+                lines.append(to_json({**row._asdict(), "metadata": None}))
+                if len(lines) >= settings.export_batch_size:
+                    yield b"\n".join(lines) + b"\n"
+                    lines = []
+            if lines:
+                yield b"\n".join(lines) + b"\n"
+        finally:
+            db.close()
 
     @staticmethod
     def delete_file(db: Session, file_id: int) -> bool:
@@ -124,10 +224,96 @@ class FileService:
         if not file_record:
             return False
 
+        # the stored object is released when purge_deleted_files hard-deletes the row
         file_record.is_deleted = True
+        file_record.deleted_at = datetime.now(timezone.utc)
         db.commit()
 
-        if file_record.b2_file_id:
-            b2_client.delete_file(file_record.b2_file_id, file_record.b2_file_name)
-
         return True
+
+    @staticmethod
+    def record_access(db: Session, file_record: FileRecord) -> None:
+        # at most one write per access_touch_interval for frequently downloaded files
+        now = datetime.now(timezone.utc)
+        cutoff = now - timedelta(seconds=settings.access_touch_interval)
+        db.query(StoredObject).filter(
+            StoredObject.file_hash == file_record.file_hash,
+            or_(
+                StoredObject.last_accessed_at.is_(None),
+                StoredObject.last_accessed_at < cutoff,
+            ),
+        ).update({"last_accessed_at": now}, synchronize_session=False)
+        db.commit()
+
+    @staticmethod
+    def request_restore(db: Session, file_record: FileRecord) -> None:
+        # only the request that flips archived -> restoring enqueues the restore
+        claimed = (
+            db.query(StoredObject)
+            .filter(
+                StoredObject.file_hash == file_record.file_hash,
+                StoredObject.storage_tier == "cold",
+                StoredObject.upload_status == "archived",
+            )
+            .update({"upload_status": "restoring"}, synchronize_session=False)
+        )
+        db.query(FileRecord).filter(
+            FileRecord.file_hash == file_record.file_hash,
+            FileRecord.upload_status == "archived",
+        ).update({"upload_status": "restoring"}, synchronize_session=False)
+
+        if claimed:
+            outbox.enqueue(db, restore_file, file_record.file_hash)
+        db.commit()
+
+    @staticmethod
+    def get_replicas(db: Session, file_record: FileRecord) -> list[dict]:
+        probes = {probe.backend: probe for probe in db.query(BackendProbe).all()}
+        replicas = [
+            {
+                "backend": PRIMARY_BACKEND,
+                "status": file_record.upload_status,
+                "public_url": file_record.public_url,
+                "updated_at": file_record.updated_at,
+            }
+        ]
+        replicas += [
+            {
+                "backend": replica.backend,
+                "status": replica.status,
+                "public_url": replica.public_url,
+                "updated_at": replica.updated_at,
+            }
+            for replica in db.query(FileReplica)
+            .filter(FileReplica.file_hash == file_record.file_hash)
+            .order_by(FileReplica.backend)
+        ]
+
+        cutoff = datetime.now(timezone.utc) - timedelta(
+            seconds=settings.replica_probe_interval * 3
+        )
+        for replica in replicas:
+            probe = probes.get(replica["backend"])
+            probed_at = probe.probed_at if probe else None
+            if probed_at and probed_at.tzinfo is None:
+                probed_at = probed_at.replace(tzinfo=timezone.utc)
+            replica["latency_ms"] = probe.latency_ms if probe else None
+            replica["is_healthy"] = bool(
+                probe and probe.is_healthy and probed_at and probed_at >= cutoff
+            )
+        return replicas
+
+    @staticmethod
+    def get_download_url(db: Session, file_record: FileRecord) -> Optional[str]:
+        # nearest healthy completed copy by recorded probe latency, else the primary
+        available = [
+            replica
+            for replica in FileService.get_replicas(db, file_record)
+            if replica["public_url"] and replica["status"] == "completed"
+        ]
+        healthy = [replica for replica in available if replica["is_healthy"]]
+        if healthy:
+            return min(healthy, key=lambda replica: replica["latency_ms"])["public_url"]
+        if file_record.public_url:
+            return file_record.public_url
+        return available[0]["public_url"] if available else None
@@ -0,0 +1,116 @@
+import os
+import shutil
+from functools import lru_cache
+from app.b2_client import B2Client, b2_client
+from app.config import settings
+import structlog
+
+logger = structlog.get_logger(__name__)
+
+PRIMARY_BACKEND = "primary"
+COLD_BACKEND = "cold"
+
+
+class B2StorageBackend:
+    def __init__(self, name: str, client: B2Client):
+        self.name = name
+        self.client = client
+
+    def upload_file(
+        self, file_path: str, file_name: str, content_type: str = None
+    ) -> dict:
+        result = self.client.upload_file(file_path, file_name, content_type)
+        return {
+            "file_id": result["b2_file_id"],
+            "file_name": result["b2_file_name"],
+            "public_url": result["public_url"],
+        }
+
+    def download_file(self, file_id: str, file_name: str, destination_path: str):
+        self.client.download_file(file_id, destination_path)
+
+    def delete_file(self, file_id: str, file_name: str) -> bool:
+        return self.client.delete_file(file_id, file_name)
+
+    def probe(self) -> None:
+        self.client.probe()
+
+
+class LocalStorageBackend:
+    # filesystem stand-in for a bucket, e.g. a mounted volume served by a CDN
+    def __init__(self, name: str, path: str, base_url: str = None):
+        self.name = name
+        self.path = os.path.abspath(path)
+        self.base_url = base_url.rstrip("/") if base_url else None
+        os.makedirs(self.path, exist_ok=True)
+
+    def upload_file(
+        self, file_path: str, file_name: str, content_type: str = None
+    ) -> dict:
+        shutil.copyfile(file_path, os.path.join(self.path, file_name))
+        return {
+            "file_id": file_name,
+            "file_name": file_name,
+            "public_url": self.get_download_url(file_name),
+        }
+
+    def download_file(self, file_id: str, file_name: str, destination_path: str):
+        shutil.copyfile(os.path.join(self.path, file_name), destination_path)
+
+    def delete_file(self, file_id: str, file_name: str) -> bool:
+        try:
+            os.remove(os.path.join(self.path, file_name))
+            return True
+        except FileNotFoundError:
+            return True
+        except OSError as e:
+            logger.error(
+                "Local file deletion failed", error=str(e), file_name=file_name
+            )
+            return False
+
+    def get_download_url(self, file_name: str) -> str:
+        if self.base_url:
+            return f"{self.base_url}/{file_name}"
+        return f"file://{os.path.join(self.path, file_name)}"
+
+    def probe(self) -> None:
+        if not os.access(self.path, os.R_OK | os.W_OK):
+            raise OSError(f"{self.path} is not readable and writable")
+
+
+def build_backend(spec: dict):
+    backend_type = spec.get("type", "b2")
+    name = spec["name"]
+
+    if backend_type == "local":
+        return LocalStorageBackend(name, spec["path"], spec.get("base_url"))
+    if backend_type == "b2":
+        return B2StorageBackend(name, B2Client(spec["bucket"]))
+
+    raise ValueError(f"Unknown storage backend type: {backend_type}")
+
+
+@lru_cache
+def get_replica_backends() -> dict:
+    return {spec["name"]: build_backend(spec) for spec in settings.replica_backends}
+
+
+@lru_cache
+def get_cold_backend():
+    return build_backend({**settings.cold_backend, "name": COLD_BACKEND})
+
+
+def get_backend(name: str):
+    if name == PRIMARY_BACKEND:
+        return B2StorageBackend(PRIMARY_BACKEND, b2_client)
+    if name == COLD_BACKEND:
+        return get_cold_backend()
+    return get_replica_backends()[name]
+
+
+def get_all_backends() -> dict:
+    backends = {PRIMARY_BACKEND: get_backend(PRIMARY_BACKEND), **get_replica_backends()}
+    if settings.cold_backend:
+        backends[COLD_BACKEND] = get_cold_backend()
+    return backends
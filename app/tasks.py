@@ -1,57 +1,394 @@
 import os
+import time
+from datetime import datetime, timezone
+from billiard import current_process
 from celery import Celery
+from celery.exceptions import Retry
+from celery.schedules import crontab
+from celery.signals import worker_process_init
+from prometheus_client import start_http_server
 from sqlalchemy.orm import sessionmaker
-from app.database import engine
-from app.models import FileRecord
+from app.database import create_db_engine, dialect_insert
+from app.models import FileRecord, StoredObject, FileReplica, BackendProbe
 from app.b2_client import b2_client
 from app.config import settings
+from app.storage import PRIMARY_BACKEND, get_backend, get_all_backends
 import structlog
 
 logger = structlog.get_logger(__name__)
 
-celery = Celery("file_service", broker=settings.redis_url, backend=settings.redis_url)
+celery = Celery(
+    "file_service",
+    broker=settings.redis_url,
+    backend=settings.redis_url,
+    include=["app.lifecycle"],
+)
+celery.conf.beat_schedule = {
+    "probe-storage-backends": {
+        "task": "app.tasks.probe_storage_backends",
+        "schedule": settings.replica_probe_interval,
+    },
+    "tier-cold-files": {
+        "task": "app.lifecycle.tier_cold_files",
+        "schedule": crontab(hour=3, minute=0),
+    },
+    "purge-deleted-files": {
+        "task": "app.lifecycle.purge_deleted_files",
+        "schedule": crontab(hour=4, minute=0),
+    },
+    "compact-files-table": {
+        "task": "app.lifecycle.compact_files_table",
+        "schedule": crontab(hour=5, minute=0, day_of_week=0),
+    },
+}
 
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+worker_engine = create_db_engine(
+    settings.database_url,
+    "worker",
+    settings.worker_db_pool_size,
+    settings.worker_db_max_overflow,
+)
+SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=worker_engine)
+
+
+@worker_process_init.connect
+def init_worker_process(**kwargs):
+    # forked children must not reuse the parent's pooled connections
+    worker_engine.dispose(close=False)
+    if settings.worker_metrics_port:
+        start_http_server(settings.worker_metrics_port + current_process().index)
+
+
+def update_shared_records(db, file_hash: str, **values) -> int:
+    # every record sharing this content follows the stored object until it has a B2 id.
+    # The stored object goes first: a duplicate upload's upsert holds the same row
+    # lock until its record commits, so the records update below sees that record
+    # and a duplicate arriving later copies the new state from the upsert
+    updated = (
+        db.query(StoredObject)
+        .filter(StoredObject.file_hash == file_hash)
+        .update(values, synchronize_session=False)
+    )
+    db.query(FileRecord).filter(
+        FileRecord.file_hash == file_hash, FileRecord.b2_file_id.is_(None)
+    ).update(values, synchronize_session=False)
+    return updated
+
+
+def claim_upload(db, file_hash: str) -> bool:
+    # only one delivery uploads a stored object, redelivered or duplicate messages
+    # find it already claimed or already carrying a B2 id
+    claimed = (
+        db.query(StoredObject)
+        .filter(
+            StoredObject.file_hash == file_hash,
+            StoredObject.b2_file_id.is_(None),
+            StoredObject.upload_status.in_(("pending", "retrying", "failed")),
+        )
+        .update({"upload_status": "uploading"}, synchronize_session=False)
+    )
+    if claimed:
+        db.query(FileRecord).filter(
+            FileRecord.file_hash == file_hash, FileRecord.b2_file_id.is_(None)
+        ).update({"upload_status": "uploading"}, synchronize_session=False)
+    db.commit()
+    return bool(claimed)
+
+
+def retry_upload(task, db, file_hash: str) -> None:
+    # failed lets the next duplicate upload try again, so it is only set once the
+    # task has given up; retrying keeps duplicates from racing the retry
+    retrying = task.request.retries < task.max_retries
+    update_shared_records(
+        db, file_hash, upload_status="retrying" if retrying else "failed"
+    )
+    db.commit()
+
+    if retrying:
+        raise task.retry(countdown=60 * (2**task.request.retries))
 
 
 @celery.task(bind=True, max_retries=3)
 def process_file_upload(self, file_record_id: int, temp_file_path: str):
     db = SessionLocal()
     try:
-        file_record = (
-            db.query(FileRecord).filter(FileRecord.id == file_record_id).first()
-        )
-        if not file_record:
-            logger.error("File record not found", file_record_id=file_record_id)
+        try:
+            file_record = (
+                db.query(FileRecord).filter(FileRecord.id == file_record_id).first()
+            )
+            if not file_record:
+                logger.error("File record not found", file_record_id=file_record_id)
+                return
+
+            if not claim_upload(db, file_record.file_hash):
+                stored = (
+                    db.query(StoredObject)
+                    .filter(StoredObject.file_hash == file_record.file_hash)
+                    .first()
+                )
+                if stored and stored.upload_status == "uploading":
+                    # another delivery is uploading, check back once it has finished
+                    logger.info(
+                        "Upload already in progress", file_record_id=file_record_id
+                    )
+                    if self.request.retries < self.max_retries:
+                        raise self.retry(countdown=60)
+                    return
+
+                if stored and stored.b2_file_id:
+                    update_shared_records(
+                        db,
+                        file_record.file_hash,
+                        b2_file_id=stored.b2_file_id,
+                        b2_file_name=stored.b2_file_name,
+                        public_url=stored.public_url,
+                        upload_status=stored.upload_status,
+                    )
+                    db.commit()
+                logger.info(
+                    "Stored object already uploaded", file_record_id=file_record_id
+                )
+                if os.path.exists(temp_file_path):
+                    os.remove(temp_file_path)
+                return
+        except Retry:
+            raise
+        except Exception as e:
+            # the outbox row is already sent, without a retry this upload is lost
+            logger.error(
+                "Claiming upload failed", file_record_id=file_record_id, error=str(e)
+            )
+            db.rollback()
+            if self.request.retries < self.max_retries:
+                raise self.retry(countdown=60 * (2**self.request.retries))
             return
 
-        file_record.upload_status = "uploading"
-        db.commit()
+        try:
+            b2_result = b2_client.upload_file(
+                temp_file_path,
+                file_record.filename,
+                file_record.content_type,
+                sha1_sum=file_record.sha1_hash,
+                file_hash=file_record.file_hash,
+            )
+        except Exception as e:
+            logger.error(
+                "File upload failed", file_record_id=file_record_id, error=str(e)
+            )
+            db.rollback()
+            retry_upload(self, db, file_record.file_hash)
+            return
 
-        b2_result = b2_client.upload_file(
-            temp_file_path, file_record.filename, file_record.content_type
-        )
+        try:
+            stored = update_shared_records(
+                db,
+                file_record.file_hash,
+                b2_file_id=b2_result["b2_file_id"],
+                b2_file_name=b2_result["b2_file_name"],
+                public_url=b2_result["public_url"],
+                upload_status="completed",
+            )
+            replicate = bool(stored and settings.replica_backends)
+            if replicate:
+                # committed with the result, the replication task removes the temp
+                # file once every replica has it
+                enqueue_replication(db, file_record.file_hash, temp_file_path)
+            db.commit()
+        except Exception as e:
+            # the object is in B2 but nothing points at it, drop it and try again
+            logger.error(
+                "Recording upload failed", file_record_id=file_record_id, error=str(e)
+            )
+            db.rollback()
+            b2_client.delete_file(b2_result["b2_file_id"], b2_result["b2_file_name"])
+            retry_upload(self, db, file_record.file_hash)
+            return
 
-        file_record.b2_file_id = b2_result["b2_file_id"]
-        file_record.b2_file_name = b2_result["b2_file_name"]
-        file_record.public_url = b2_result["public_url"]
-        file_record.upload_status = "completed"
-        db.commit()
+        # the upload is committed from here on, nothing below may mark it failed
+        if not stored:
+            # every reference was deleted while we were uploading
+            logger.info(
+                "Stored object released during upload", file_hash=file_record.file_hash
+            )
+            b2_client.delete_file(b2_result["b2_file_id"], b2_result["b2_file_name"])
 
-        if os.path.exists(temp_file_path):
+        if not replicate and os.path.exists(temp_file_path):
             os.remove(temp_file_path)
 
         logger.info("File upload completed", file_record_id=file_record_id)
 
-    except Exception as e:
-        logger.error("File upload failed", file_record_id=file_record_id, error=str(e))
+    finally:
+        db.close()
+
+
+def schedule_replicas(db, file_hash: str) -> None:
+    insert = dialect_insert(db)
+    db.execute(
+        insert(FileReplica)
+        .values(
+            [
+                {"file_hash": file_hash, "backend": spec["name"], "status": "pending"}
+                for spec in settings.replica_backends
+            ]
+        )
+        .on_conflict_do_nothing(index_elements=["file_hash", "backend"])
+    )
+
+
+def enqueue_replication(db, file_hash: str, temp_file_path: str) -> None:
+    # via the outbox, so a broker outage after commit cannot fail the caller
+    from app import outbox
 
-        if "file_record" in locals():
-            file_record.upload_status = "failed"
+    schedule_replicas(db, file_hash)
+    outbox.enqueue(db, replicate_file, file_hash, temp_file_path)
+
+
+@celery.task(bind=True, max_retries=3)
+def replicate_file(self, file_hash: str, temp_file_path: str):
+    db = SessionLocal()
+    try:
+        try:
+            stored = (
+                db.query(StoredObject)
+                .filter(StoredObject.file_hash == file_hash)
+                .first()
+            )
+            replicas = (
+                db.query(FileReplica)
+                .filter(
+                    FileReplica.file_hash == file_hash,
+                    FileReplica.status.in_(("pending", "failed")),
+                )
+                .all()
+            )
+            # tiered or released since the upload, only a hot object is copied
+            is_hot = (
+                stored is not None
+                and stored.storage_tier == "hot"
+                and stored.upload_status == "completed"
+                and stored.b2_file_id is not None
+            )
+            if not is_hot or not replicas:
+                in_progress = (
+                    db.query(FileReplica.id)
+                    .filter(
+                        FileReplica.file_hash == file_hash,
+                        FileReplica.status == "uploading",
+                    )
+                    .first()
+                )
+                # a redelivered message shares the temp file with the delivery uploading
+                if not in_progress and os.path.exists(temp_file_path):
+                    os.remove(temp_file_path)
+                return
+
+            if not os.path.exists(temp_file_path):
+                os.makedirs(os.path.dirname(temp_file_path), exist_ok=True)
+                get_backend(PRIMARY_BACKEND).download_file(
+                    stored.b2_file_id, stored.b2_file_name, temp_file_path
+                )
+
+            content_type = (
+                db.query(FileRecord.content_type)
+                .filter(FileRecord.file_hash == file_hash)
+                .limit(1)
+                .scalar()
+            )
+        except Exception as e:
+            logger.error("Replication setup failed", file_hash=file_hash, error=str(e))
+            db.rollback()
+            if self.request.retries < self.max_retries:
+                raise self.retry(countdown=60 * (2**self.request.retries))
+
+            # given up, nothing should keep reporting these copies as on their way
+            db.query(FileReplica).filter(
+                FileReplica.file_hash == file_hash, FileReplica.status == "pending"
+            ).update({"status": "failed"}, synchronize_session=False)
+            db.commit()
+            return
+
+        failed = []
+        for replica in replicas:
+            # claimed one at a time, a redelivered message skips what this one holds
+            claimed = (
+                db.query(FileReplica)
+                .filter(
+                    FileReplica.id == replica.id,
+                    FileReplica.status.in_(("pending", "failed")),
+                )
+                .update({"status": "uploading"}, synchronize_session=False)
+            )
+            db.commit()
+            if not claimed:
+                continue
+            try:
+                result = get_backend(replica.backend).upload_file(
+                    temp_file_path, stored.b2_file_name, content_type
+                )
+                replica.remote_file_id = result["file_id"]
+                replica.remote_file_name = result["file_name"]
+                replica.public_url = result["public_url"]
+                replica.status = "completed"
+            except Exception as e:
+                logger.error(
+                    "Replication failed",
+                    file_hash=file_hash,
+                    backend=replica.backend,
+                    error=str(e),
+                )
+                replica.status = "failed"
+                failed.append(replica.backend)
             db.commit()
 
-        if self.request.retries < self.max_retries:
+        if failed and self.request.retries < self.max_retries:
             raise self.retry(countdown=60 * (2**self.request.retries))
 
+        if os.path.exists(temp_file_path):
+            os.remove(temp_file_path)
+
+        logger.info("File replicated", file_hash=file_hash, failed=failed)
+
+    finally:
+        db.close()
+
+
+@celery.task
+def delete_backend_objects(objects: list):
+    for backend_name, remote_file_id, remote_file_name in objects:
+        try:
+            get_backend(backend_name).delete_file(remote_file_id, remote_file_name)
+        except Exception as e:
+            logger.error(
+                "Stored object deletion failed",
+                backend=backend_name,
+                remote_file_id=remote_file_id,
+                error=str(e),
+            )
+
+
+@celery.task
+def probe_storage_backends():
+    db = SessionLocal()
+    try:
+        for name, backend in get_all_backends().items():
+            start = time.perf_counter()
+            try:
+                backend.probe()
+                is_healthy = True
+            except Exception as e:
+                logger.warning(
+                    "Storage backend probe failed", backend=name, error=str(e)
+                )
+                is_healthy = False
+
+            db.merge(
+                BackendProbe(
+                    backend=name,
+                    latency_ms=(time.perf_counter() - start) * 1000,
+                    is_healthy=is_healthy,
+                    probed_at=datetime.now(timezone.utc),
+                )
+            )
+        db.commit()
     finally:
         db.close()
@@ -0,0 +1,474 @@
+"""
+Offline benchmark for the upload pipeline.
+
+Storage (B2) and the Celery broker are replaced with in-process stand-ins and the
+database is a throwaway SQLite file, so nothing here needs network access.
+
+Run with: python -m app.tests.benchmark --output bench.json
+Compare:  python -m app.tests.benchmark --baseline bench.json --tolerance 0.25
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import resource
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import types
+import uuid
+
+import structlog
+
+WORKDIR = tempfile.mkdtemp(prefix="file-service-bench-")
+
+# overwrite, never default: inside the api/celery containers these point at the real
+# Postgres, replicas and buckets, and the benchmark writes thousands of fake rows
+os.environ.update(
+    DATABASE_URL=f"sqlite:///{WORKDIR}/bench.db",
+    REPLICA_DATABASE_URLS="[]",
+    REDIS_URL="memory://",
+    B2_APPLICATION_KEY_ID="bench",
+    B2_APPLICATION_KEY="bench",
+    B2_BUCKET_NAME="bench",
+    REPLICA_BACKENDS="[]",
+    COLD_BACKEND="{}",
+)
+
+SIZE_DISTRIBUTIONS = {
+    "small": (1 * 1024, 64 * 1024),
+    "medium": (256 * 1024, 1024 * 1024),
+    "large": (4 * 1024 * 1024, 8 * 1024 * 1024),
+}
+PAGE_DEPTHS = [1, 10, 50]
+
+# uploads are named .txt, so random bytes are folded onto letters to pass sniffing
+TEXT_BYTES = bytes(ord("a") + b % 26 for b in range(256))
+
+
+class FakeB2Client:
+    """Stores uploads on the local filesystem and mimics B2Client's return values."""
+
+    def __init__(self, root: str):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def upload_file(
+        self,
+        file_path: str,
+        file_name: str,
+        content_type: str = None,
+        sha1_sum: str = None,
+        file_hash: str = None,
+    ) -> dict:
+        file_id = uuid.uuid4().hex
+        shutil.copyfile(file_path, os.path.join(self.root, file_id))
+        return {
+            "b2_file_id": file_id,
+            "b2_file_name": file_name,
+            "file_hash": file_hash,
+            "public_url": self.get_download_url(file_id),
+            "content_type": content_type,
+        }
+
+    def delete_file(self, file_id: str, file_name: str) -> bool:
+        path = os.path.join(self.root, file_id)
+        if os.path.exists(path):
+            os.remove(path)
+        return True
+
+    def get_download_url(self, file_id: str) -> str:
+        return f"file://{self.root}/{file_id}"
+
+    def download_file(self, file_id: str, destination_path: str) -> None:
+        shutil.copyfile(os.path.join(self.root, file_id), destination_path)
+
+    def probe(self) -> None:
+        pass
+
+
+def install_fakes():
+    """Swap in the fake storage client before any app module imports it."""
+    fake_module = types.ModuleType("app.b2_client")
+    fake_module.B2Client = FakeB2Client
+    fake_module.b2_client = FakeB2Client(os.path.join(WORKDIR, "bucket"))
+    sys.modules["app.b2_client"] = fake_module
+
+    from app import tasks
+
+    tasks.celery.conf.update(broker_url="memory://", result_backend="cache+memory://")
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is reported in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def summarize(latencies: list[float], elapsed: float, **extra) -> dict:
+    ordered = sorted(latencies)
+    if len(ordered) > 1:
+        cuts = statistics.quantiles(ordered, n=100, method="inclusive")
+        p50, p95, p99 = cuts[49], cuts[94], cuts[98]
+    else:
+        p50 = p95 = p99 = ordered[0] if ordered else 0.0
+
+    return {
+        "count": len(ordered),
+        "elapsed_s": round(elapsed, 4),
+        "ops_per_s": round(len(ordered) / elapsed, 2) if elapsed else 0.0,
+        "p50_ms": round(p50 * 1000, 3),
+        "p95_ms": round(p95 * 1000, 3),
+        "p99_ms": round(p99 * 1000, 3),
+        "peak_rss_mb": round(peak_rss_mb(), 2),
+        **extra,
+    }
+
+
+async def run_concurrently(make_request, total: int, concurrency: int):
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def timed(i):
+        async with semaphore:
+            start = time.perf_counter()
+            response = await make_request(i)
+            latencies.append(time.perf_counter() - start)
+            if response.status_code != 200:
+                raise RuntimeError(
+                    f"{response.request.url} -> {response.status_code}: {response.text}"
+                )
+
+    start = time.perf_counter()
+    await asyncio.gather(*(timed(i) for i in range(total)))
+    return latencies, time.perf_counter() - start
+
+
+async def measure_loop_stall(awaitable, interval=0.001):
+    """Await ``awaitable`` while a ticker records how late the event loop wakes it."""
+    lags = []
+    done = asyncio.Event()
+
+    async def ticker():
+        while not done.is_set():
+            start = time.perf_counter()
+            await asyncio.sleep(interval)
+            lags.append(max(time.perf_counter() - start - interval, 0.0))
+
+    task = asyncio.create_task(ticker())
+    try:
+        result = await awaitable
+    finally:
+        done.set()
+        await task
+
+    ordered = sorted(lags) or [0.0]
+    stall = {
+        "loop_stall_max_ms": round(ordered[-1] * 1000, 3),
+        "loop_stall_p99_ms": round(ordered[int(len(ordered) * 0.99) - 1] * 1000, 3),
+    }
+    return result, stall
+
+
+async def bench_uploads(client, rng, sizes, total, concurrency):
+    results = {}
+    for name in sizes:
+        low, high = SIZE_DISTRIBUTIONS[name]
+        payloads = [
+            rng.randbytes(rng.randint(low, high)).translate(TEXT_BYTES)
+            for _ in range(total)
+        ]
+
+        async def upload(i):
+            files = {"file": (f"bench_{name}_{i}.txt", payloads[i], "text/plain")}
+            return await client.post("/upload", files=files)
+
+        (latencies, elapsed), stall = await measure_loop_stall(
+            run_concurrently(upload, total, concurrency)
+        )
+        megabytes = sum(len(p) for p in payloads) / (1024 * 1024)
+        results[name] = summarize(
+            latencies, elapsed, mb_per_s=round(megabytes / elapsed, 2), **stall
+        )
+    return results
+
+
+async def bench_hash_stall(rng, size_mb, rounds=5):
+    """Event loop stall of hashing one upload inline versus in the hash pool."""
+    import hashlib
+    import io
+
+    from app.hashing import compute_digests_async
+
+    data = rng.randbytes(size_mb * 1024 * 1024)
+
+    async def inline():
+        # what create_file_record used to do on the event loop
+        for _ in range(rounds):
+            hashlib.sha256(data).hexdigest()
+            hashlib.sha1(data).hexdigest()
+            await asyncio.sleep(0)
+
+    async def pooled():
+        for _ in range(rounds):
+            await compute_digests_async(io.BytesIO(data))
+
+    results = {}
+    for name, run_hashes in (("inline", inline), ("thread_pool", pooled)):
+        start = time.perf_counter()
+        _, stall = await measure_loop_stall(run_hashes())
+        elapsed = time.perf_counter() - start
+        results[name] = {
+            "size_mb": size_mb,
+            "mb_per_s": round(size_mb * rounds / elapsed, 2),
+            **stall,
+        }
+    return results
+
+
+async def bench_dedup(client, rng, total, concurrency):
+    content = rng.randbytes(64 * 1024).translate(TEXT_BYTES)
+    response = await client.post(
+        "/upload", files={"file": ("dedup_seed.txt", content, "text/plain")}
+    )
+    response.raise_for_status()
+
+    async def upload(i):
+        files = {"file": (f"dedup_{i}.txt", content, "text/plain")}
+        return await client.post("/upload", files=files)
+
+    latencies, elapsed = await run_concurrently(upload, total, concurrency)
+    return summarize(latencies, elapsed)
+
+
+async def bench_get_file(client, file_ids, total, concurrency):
+    async def get(i):
+        return await client.get(f"/files/{file_ids[i % len(file_ids)]}")
+
+    latencies, elapsed = await run_concurrently(get, total, concurrency)
+    return summarize(latencies, elapsed)
+
+
+async def bench_list_files(client, total, concurrency, page_size=100):
+    results = {}
+    for page in PAGE_DEPTHS:
+
+        async def list_page(i):
+            return await client.get("/files", params={"page": page, "size": page_size})
+
+        latencies, elapsed = await run_concurrently(list_page, total, concurrency)
+        results[f"page_{page}"] = summarize(latencies, elapsed)
+    return results
+
+
+def seed_rows(count: int):
+    """Insert metadata-only rows so listing has enough pages to walk."""
+    from app.database import SessionLocal
+    from app.models import FileRecord
+
+    db = SessionLocal()
+    try:
+        db.bulk_save_objects(
+            [
+                FileRecord(
+                    filename=f"{uuid.uuid4()}.txt",
+                    original_filename=f"seed_{i}.txt",
+                    file_size=1024,
+                    content_type="text/plain",
+                    file_hash=uuid.uuid4().hex * 2,
+                    upload_status="completed",
+                    uploaded_by="bench_seed",
+                    public_url=f"file:///seed/{i}",
+                )
+                for i in range(count)
+            ]
+        )
+        db.commit()
+    finally:
+        db.close()
+
+
+def bench_relay():
+    from app.database import SessionLocal
+    from app.outbox import relay_batch
+
+    latencies = []
+    sent = 0
+    db = SessionLocal()
+    try:
+        start = time.perf_counter()
+        while True:
+            batch_start = time.perf_counter()
+            batch = relay_batch(db)
+            if not batch:
+                break
+            latencies.append(time.perf_counter() - batch_start)
+            sent += batch
+        elapsed = time.perf_counter() - start
+    finally:
+        db.close()
+    return summarize(
+        latencies, elapsed, messages=sent, messages_per_s=round(sent / elapsed, 2)
+    )
+
+
+def bench_worker():
+    from app.database import SessionLocal
+    from app.models import OutboxMessage
+    from app.tasks import process_file_upload
+
+    db = SessionLocal()
+    try:
+        queued = [
+            json.loads(payload)
+            for (payload,) in db.query(OutboxMessage.payload)
+            .filter(OutboxMessage.task_name == process_file_upload.name)
+            .order_by(OutboxMessage.id)
+        ]
+    finally:
+        db.close()
+
+    latencies = []
+    start = time.perf_counter()
+    for args in queued:
+        task_start = time.perf_counter()
+        process_file_upload.apply(args=args)
+        latencies.append(time.perf_counter() - task_start)
+    return summarize(latencies, time.perf_counter() - start)
+
+
+async def run(args) -> dict:
+    import httpx
+
+    install_fakes()
+
+    from app.config import settings
+    from app.main import app
+
+    # keep stdout for the report; the app logs every request at INFO
+    structlog.configure(
+        wrapper_class=structlog.make_filtering_bound_logger(logging.WARNING)
+    )
+
+    settings.temp_upload_dir = os.path.join(WORKDIR, "temp_uploads")
+    rng = random.Random(args.seed)
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(
+        transport=transport, base_url="http://bench"
+    ) as client:
+        uploads = await bench_uploads(
+            client, rng, args.sizes, args.uploads, args.concurrency
+        )
+        dedup = await bench_dedup(client, rng, args.uploads, args.concurrency)
+        hash_stall = await bench_hash_stall(rng, args.hash_size_mb)
+
+        relay = bench_relay()
+        worker = bench_worker()
+
+        seed_rows(args.seed_rows)
+        listing = await client.get("/files", params={"size": 100})
+        file_ids = [f["id"] for f in listing.json()["files"]]
+
+        get_file = await bench_get_file(
+            client, file_ids, args.requests, args.concurrency
+        )
+        list_files = await bench_list_files(client, args.requests, args.concurrency)
+
+    return {
+        "meta": {
+            "python": sys.version.split()[0],
+            "uploads_per_size": args.uploads,
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "seed_rows": args.seed_rows,
+            "seed": args.seed,
+        },
+        "upload": uploads,
+        "dedup_hit": dedup,
+        "hash_stall": hash_stall,
+        "get_file": get_file,
+        "list_files": list_files,
+        "outbox_relay": relay,
+        "worker": worker,
+        "peak_rss_mb": round(peak_rss_mb(), 2),
+    }
+
+
+def iter_metrics(report: dict, prefix: str = ""):
+    for key, value in report.items():
+        if key == "meta":
+            continue
+        if isinstance(value, dict):
+            yield from iter_metrics(value, f"{prefix}{key}.")
+        else:
+            yield f"{prefix}{key}", value
+
+
+def compare(report: dict, baseline: dict, tolerance: float) -> list[str]:
+    """Return the latency metrics that got slower than the baseline allows."""
+    current = dict(iter_metrics(report))
+    regressions = []
+    for name, old in iter_metrics(baseline):
+        if not name.endswith(("p95_ms", "p99_ms")) or name not in current:
+            continue
+        new = current[name]
+        if old and new > old * (1 + tolerance):
+            regressions.append(f"{name}: {old} -> {new}")
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline upload pipeline benchmark")
+    parser.add_argument("--uploads", type=int, default=50, help="uploads per size")
+    parser.add_argument("--requests", type=int, default=500, help="reads per scenario")
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--seed-rows", type=int, default=5000)
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--hash-size-mb", type=int, default=32)
+    parser.add_argument(
+        "--sizes",
+        nargs="+",
+        choices=sorted(SIZE_DISTRIBUTIONS),
+        default=list(SIZE_DISTRIBUTIONS),
+    )
+    parser.add_argument("--output", help="write the JSON report to this path")
+    parser.add_argument("--baseline", help="JSON report to compare against")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.25,
+        help="allowed relative p95/p99 slowdown against the baseline",
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    try:
+        report = asyncio.run(run(args))
+    finally:
+        shutil.rmtree(WORKDIR, ignore_errors=True)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    print(output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        if regressions:
+            print("Latency regressions:", *regressions, sep="\n  ", file=sys.stderr)
+            return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,6 +3,8 @@
 Run with: pytest test_fixed_api.py -v
 """
 
+import json
+import os
 import requests
 import pytest
 from io import BytesIO
@@ -11,6 +13,8 @@ import uuid
 import random
 
 BASE_URL = "http://localhost:8000"
+# same database as the running service, for states only background jobs reach
+DATABASE_URL = os.getenv("DATABASE_URL")
 
 
 class TestFixedAPI:
@@ -27,6 +31,14 @@ class TestFixedAPI:
         assert data["status"] == "healthy"
         assert data["service"] == "file-upload-service"
 
+    def test_metrics(self):
+        response = requests.get(f"{BASE_URL}/metrics")
+
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/plain")
+        assert "db_pool_checkouts_total" in response.text
+        assert "db_pool_wait_seconds" in response.text
+
     def test_upload_text_file(self):
         test_content = self.generate_unique_content(
             "Hello, World! This is a test file."
@@ -127,6 +139,14 @@ class TestFixedAPI:
         else:
             assert response.status_code == 400
 
+    def test_upload_spoofed_extension(self):
+        fake_png = self.generate_unique_content("not really a png")
+        files = {"file": ("spoofed.png", BytesIO(fake_png), "image/png")}
+
+        response = requests.post(f"{BASE_URL}/upload", files=files)
+
+        assert response.status_code == 415
+
     def test_get_file_info(self):
         test_content = self.generate_unique_content("Get file info test")
         files = {"file": ("get_info_test.txt", BytesIO(test_content), "text/plain")}
@@ -191,6 +211,36 @@ class TestFixedAPI:
         response = requests.get(f"{BASE_URL}/files?size=1000")
         assert response.status_code == 422
 
+    def test_export_files_ndjson(self):
+        uploaded_by = f"pytest_export_{uuid.uuid4().hex[:8]}"
+        file_ids = []
+        for i in range(3):
+            content = self.generate_unique_content(f"Export test file {i}")
+            files = {"file": (f"export_{i}.txt", BytesIO(content), "text/plain")}
+            response = requests.post(
+                f"{BASE_URL}/upload",
+                files=files,
+                params={"uploaded_by": uploaded_by},
+            )
+            assert response.status_code == 200, f"Upload failed: {response.text}"
+            file_ids.append(response.json()["file_id"])
+
+        response = requests.get(
+            f"{BASE_URL}/files/export", params={"uploaded_by": uploaded_by}
+        )
+
+        assert (
+            response.status_code == 200
+        ), f"Expected 200, got {response.status_code}: {response.text}"
+        assert response.headers["content-type"].startswith("application/x-ndjson")
+        rows = [json.loads(line) for line in response.text.splitlines()]
+        assert [row["id"] for row in rows] == file_ids
+        for row in rows:
+            assert row["uploaded_by"] == uploaded_by
+            assert row["original_filename"].startswith("export_")
+            assert "file_hash" in row
+            assert "created_at" in row
+
     def test_download_url_for_uploaded_file(self):
         test_content = self.generate_unique_content("Download URL test")
         files = {"file": ("download_test.txt", BytesIO(test_content), "text/plain")}
@@ -214,10 +264,91 @@ class TestFixedAPI:
             assert "download_url" in data
             assert isinstance(data["download_url"], str)
 
+    def test_download_archived_file_starts_restore(self):
+        if not DATABASE_URL:
+            pytest.skip("DATABASE_URL is needed to archive a file")
+        from sqlalchemy import create_engine, text
+
+        test_content = self.generate_unique_content("Archived download test")
+        files = {"file": ("archived_test.txt", BytesIO(test_content), "text/plain")}
+
+        upload_response = requests.post(f"{BASE_URL}/upload", files=files)
+        assert (
+            upload_response.status_code == 200
+        ), f"Upload failed: {upload_response.text}"
+        file_id = upload_response.json()["file_id"]
+        file_hash = requests.get(f"{BASE_URL}/files/{file_id}").json()["file_hash"]
+
+        # what tier_cold_files leaves behind
+        engine = create_engine(DATABASE_URL)
+        with engine.begin() as conn:
+            conn.execute(
+                text(
+                    "UPDATE stored_objects SET storage_tier = 'cold', "
+                    "upload_status = 'archived', b2_file_id = NULL, "
+                    "cold_file_id = 'archived-test' WHERE file_hash = :file_hash"
+                ),
+                {"file_hash": file_hash},
+            )
+            conn.execute(
+                text(
+                    "UPDATE files SET upload_status = 'archived', b2_file_id = NULL, "
+                    "public_url = NULL WHERE file_hash = :file_hash"
+                ),
+                {"file_hash": file_hash},
+            )
+        engine.dispose()
+
+        response = requests.get(f"{BASE_URL}/files/{file_id}/download")
+
+        assert (
+            response.status_code == 202
+        ), f"Expected 202, got {response.status_code}: {response.text}"
+        assert response.json()["status"] == "restoring"
+
+        response = requests.get(f"{BASE_URL}/files/{file_id}")
+        assert response.json()["upload_status"] == "restoring"
+
+        # a second request while the restore runs is still accepted
+        response = requests.get(f"{BASE_URL}/files/{file_id}/download")
+        assert response.status_code == 202
+
     def test_download_url_nonexistent_file(self):
         response = requests.get(f"{BASE_URL}/files/999999/download")
         assert response.status_code == 404
 
+    def test_file_replicas(self):
+        test_content = self.generate_unique_content("Replica listing test")
+        files = {"file": ("replica_test.txt", BytesIO(test_content), "text/plain")}
+
+        upload_response = requests.post(f"{BASE_URL}/upload", files=files)
+        assert (
+            upload_response.status_code == 200
+        ), f"Upload failed: {upload_response.text}"
+        file_id = upload_response.json()["file_id"]
+
+        response = requests.get(f"{BASE_URL}/files/{file_id}/replicas")
+
+        assert (
+            response.status_code == 200
+        ), f"Expected 200, got {response.status_code}: {response.text}"
+        replicas = response.json()
+        assert isinstance(replicas, list)
+        assert replicas[0]["backend"] == "primary"
+        for replica in replicas:
+            assert set(replica) == {
+                "backend",
+                "status",
+                "public_url",
+                "latency_ms",
+                "is_healthy",
+                "updated_at",
+            }
+            assert isinstance(replica["is_healthy"], bool)
+
+        response = requests.get(f"{BASE_URL}/files/999999/replicas")
+        assert response.status_code == 404
+
     def test_delete_nonexistent_file(self):
         response = requests.delete(f"{BASE_URL}/files/999999")
         assert response.status_code == 404
@@ -313,17 +444,40 @@ class TestFixedAPI:
             response.status_code == 404
         ), f"File should be deleted but got: {response.status_code}"
 
+    def upload_duplicates(self, base_text):
+        content = self.generate_unique_content(base_text)
+        file_ids = []
+        for name in ("dedup_test1.txt", "dedup_test2.txt"):
+            files = {"file": (name, BytesIO(content), "text/plain")}
+            response = requests.post(f"{BASE_URL}/upload", files=files)
+            assert response.status_code == 200, f"Upload failed: {response.text}"
+            file_ids.append(response.json()["file_id"])
+        return file_ids
+
     def test_file_deduplication_feature(self):
-        content = b"Deduplication test content - exact same bytes"
+        file_id1, file_id2 = self.upload_duplicates("Deduplication test content")
+        assert file_id1 != file_id2
 
-        files1 = {"file": ("dedup_test1.txt", BytesIO(content), "text/plain")}
-        response1 = requests.post(f"{BASE_URL}/upload", files=files1)
+        info1 = requests.get(f"{BASE_URL}/files/{file_id1}").json()
+        info2 = requests.get(f"{BASE_URL}/files/{file_id2}").json()
+        assert info1["file_hash"] == info2["file_hash"]
+        assert info1["original_filename"] == "dedup_test1.txt"
+        assert info2["original_filename"] == "dedup_test2.txt"
+
+    def test_deleting_duplicate_keeps_other_copy(self):
+        file_id1, file_id2 = self.upload_duplicates("Deduplication delete test")
+        before = requests.get(f"{BASE_URL}/files/{file_id2}/download")
+
+        response = requests.delete(f"{BASE_URL}/files/{file_id1}")
+        assert response.status_code == 200, f"Delete failed: {response.text}"
 
-        files2 = {"file": ("dedup_test2.txt", BytesIO(content), "text/plain")}
-        response2 = requests.post(f"{BASE_URL}/upload", files=files2)
+        assert requests.get(f"{BASE_URL}/files/{file_id1}").status_code == 404
+        assert requests.get(f"{BASE_URL}/files/{file_id2}").status_code == 200
 
-        assert response1.status_code == 200
-        assert response2.status_code in [200, 409]
+        after = requests.get(f"{BASE_URL}/files/{file_id2}/download")
+        assert after.status_code == before.status_code
+        if before.status_code == 200:
+            assert after.json()["download_url"] == before.json()["download_url"]
 
 
 if __name__ == "__main__":